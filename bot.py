@@ -1,19 +1,29 @@
 import os
 import logging
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import asyncio
 import time
 import tempfile
-from datetime import datetime
-from collections import defaultdict
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from itertools import islice
+from functools import lru_cache
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import html
 import re
+import hashlib
+import secrets
+import random
 import base64
 import json
+import orjson
 
 # 🔥 KOYEB-SPECIFIC SETUP
 from flask import Flask
-from threading import Thread
+from threading import Thread, Event
 
 # Koyeb uses PORT environment variable
 port = int(os.environ.get("PORT", 8080))
@@ -64,24 +74,40 @@ load_dotenv()
 # Logging Configuration
 # -------------------------
 
-class ContextFilter(logging.Filter):
-    def filter(self, record):
-        if not hasattr(record, "user_id"):
-            record.user_id = "N/A"
-        return True
-
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - User %(user_id)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
 
-for handler in logging.getLogger().handlers:
-    handler.addFilter(ContextFilter())
-
-def log_info(msg, user_id="N/A"):
-    logger.info(msg, extra={"user_id": user_id})
+# Handlers on the event loop only enqueue records; a background thread does the stderr I/O
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logging.Formatter(
+    "%(asctime)s - %(levelname)s - User %(user_id)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    # log_info always sets user_id; records from PTB, httpx etc. fall back to this
+    defaults={"user_id": "N/A"}
+))
+
+root_logger = logging.getLogger()
+root_logger.handlers.clear()
+root_logger.addHandler(queue_handler)
+root_logger.setLevel(logging.INFO)
+
+log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Fraction of routine per-message lines (sample=True) to keep, e.g. LOG_SAMPLE_RATE=0.01;
+# warnings and errors are never sampled
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+def log_info(msg, *args, user_id="N/A", level=logging.INFO, exc_info=None, sample=False):
+    # Drop sampled-out lines before a LogRecord is even built
+    if sample and level < logging.WARNING and random.random() >= LOG_SAMPLE_RATE:
+        return
+    # Pass %s-style args so formatting only happens when the record is emitted
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={"user_id": user_id}, exc_info=exc_info)
 
 # -------------------------
 # Environment / API keys
@@ -90,11 +116,11 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
 if not TELEGRAM_TOKEN:
-    log_info("Missing TELEGRAM_TOKEN", "N/A")
+    log_info("Missing TELEGRAM_TOKEN")
     raise SystemExit("Missing TELEGRAM_TOKEN")
 
 if not GEMINI_API_KEY:
-    log_info("Missing GEMINI_API_KEY", "N/A")
+    log_info("Missing GEMINI_API_KEY")
     raise SystemExit("Missing GEMINI_API_KEY")
 
 # Configure Gemini
@@ -104,31 +130,243 @@ try:
     # Use a model that supports vision
     model = genai.GenerativeModel("")
     vision_model = genai.GenerativeModel("")
-    log_info("Gemini configured successfully with vision support", "N/A")
+    # Built once and reused for every call. Replies past ~1k tokens get cut at Telegram's
+    # message limit anyway; file analyses get more room since they're kept in memory.
+    GEN_CONFIG = genai.types.GenerationConfig(temperature=0.7, max_output_tokens=1024, candidate_count=1)
+    VISION_GEN_CONFIG = genai.types.GenerationConfig(temperature=0.7, max_output_tokens=2048, candidate_count=1)
+    log_info("Gemini configured successfully with vision support")
 except Exception as e:
-    log_info(f"Gemini configuration failed: {e}", "N/A")
+    log_info("Gemini configuration failed: %s", e)
     model = None
     vision_model = None
+    GEN_CONFIG = None
+    VISION_GEN_CONFIG = None
+
+# Cap in-flight Gemini requests so bursts queue here instead of at the API quota;
+# GEMINI_CONCURRENCY tunes it to the key's rate limit
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", 32))
+# Created in start_background_loops, on the loop that runs the bot
+GEMINI_SEM = None
 
 # -------------------------
 # ENHANCED User context with COMPREHENSIVE FILE MEMORY
 # -------------------------
-user_context = defaultdict(lambda: {
+# Keep last 15 messages for better memory; the deque evicts the oldest on append
+MAX_HISTORY = 15
+# Earlier exchanges rendered into each prompt
+CONTEXT_EXCHANGES = 6
+# Keep only last 10 files to prevent memory overload
+MAX_FILES = 10
+# Least recently active users are dropped past this many so memory stays bounded
+MAX_USERS = 50_000
+# Per-turn character budgets so one huge message can't blow up every later prompt
+MAX_PROMPT_USER_CHARS = 1500
+MAX_PROMPT_HISTORY_CHARS = 1500
+# Questions are trimmed before they enter history, so an oversized message isn't
+# kept (and snapshotted) in full for MAX_HISTORY turns
+MAX_STORED_QUESTION_CHARS = 1000
+
+class UserContextStore(OrderedDict):
+    """LRU-bounded user store; profiles are only created through get_or_create"""
+
+    def __init__(self, factory, max_users: int):
+        super().__init__()
+        self.factory = factory
+        self.max_users = max_users
+        # Running totals so health checks don't have to walk every user
+        self._total_messages = 0
+        self._total_files = 0
+        # Users written or evicted since the last snapshot, so only those are re-serialized
+        self.dirty = set()
+
+    @property
+    def total_messages(self) -> int:
+        return self._total_messages
+
+    @property
+    def total_files(self) -> int:
+        return self._total_files
+
+    def get_or_create(self, user_id) -> dict:
+        ctx = self.get(user_id)
+        if ctx is None:
+            ctx = self.factory()
+            self[user_id] = ctx
+        else:
+            self.move_to_end(user_id)
+        return ctx
+
+    def __getitem__(self, user_id) -> dict:
+        # Plain reads never allocate a profile - a missing user is a KeyError
+        ctx = super().__getitem__(user_id)
+        self.move_to_end(user_id)
+        return ctx
+
+    def __setitem__(self, user_id, ctx: dict):
+        previous = self.get(user_id)
+        if previous is not None:
+            self._forget(previous)
+        super().__setitem__(user_id, ctx)
+        self.move_to_end(user_id)
+        self.dirty.add(user_id)
+        self._total_messages += len(ctx["history"])
+        self._total_files += len(ctx["file_memory"])
+        while len(self) > self.max_users:
+            evicted_id, evicted = self.popitem(last=False)
+            self._forget(evicted)
+            self.dirty.add(evicted_id)
+
+    def _forget(self, ctx: dict):
+        self._total_messages -= len(ctx["history"])
+        self._total_files -= len(ctx["file_memory"])
+
+    def add_history(self, user_id, entry: dict):
+        """Append a history entry, keeping the message total in step with deque eviction"""
+        history = self.get(user_id)["history"]
+        if len(history) < history.maxlen:
+            self._total_messages += 1
+        history.append(entry)
+        self.dirty.add(user_id)
+
+    def add_file(self, user_id, entry: dict):
+        """Append a file analysis; the deque drops the oldest past MAX_FILES"""
+        file_memory = self.get(user_id)["file_memory"]
+        if len(file_memory) < file_memory.maxlen:
+            self._total_files += 1
+        file_memory.append(entry)
+        self.dirty.add(user_id)
+
+    def touch(self, user_id):
+        """Mark a profile dirty after editing it in place"""
+        self.dirty.add(user_id)
+
+# Immutable defaults for a new profile; containers are added fresh in new_profile
+PROFILE_TEMPLATE = {
     "level": "beginner",
     "language": "English", 
     "last_topic": None,
-    "history": [],
-    "first_seen": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-    "learning_goals": [],
-    "weak_areas": [],
-    "strengths": [],
-    "writing_projects": [],
     "current_essay": None,
-    "grammar_issues": [],
-    "uploaded_documents": [],
     "current_file_analysis": None,  # Track current file being discussed
-    "file_memory": []  # Store all file analyses with metadata
-})
+    "profile_summary": None  # Cached learning profile text, cleared when the profile changes
+}
+
+def new_profile() -> dict:
+    profile = PROFILE_TEMPLATE.copy()
+    profile["history"] = deque(maxlen=MAX_HISTORY)
+    profile["first_seen"] = int(time.time())
+    profile["learning_goals"] = set()
+    profile["weak_areas"] = set()
+    profile["strengths"] = set()
+    profile["writing_projects"] = set()
+    profile["grammar_issues"] = []
+    profile["uploaded_documents"] = []
+    profile["file_memory"] = deque(maxlen=MAX_FILES)  # Store all file analyses with metadata
+    return profile
+
+user_context = UserContextStore(new_profile, MAX_USERS)
+
+# ============================================================================
+# User context persistence
+# ============================================================================
+
+SNAPSHOT_PATH = os.getenv("CONTEXT_SNAPSHOT_PATH", "user_context.json")
+SNAPSHOT_INTERVAL = 30
+# Stored as JSON lists, rebuilt as sets on load
+PROFILE_SET_KEYS = ("learning_goals", "weak_areas", "strengths", "writing_projects")
+# Derived caches are rebuilt on demand, so they stay out of the snapshot
+SNAPSHOT_SKIP_KEYS = frozenset({"profile_summary"})
+# Each user's last serialized profile, so a snapshot only re-encodes the dirty ones
+snapshot_blobs = {}
+# Set while encoded changes haven't reached disk, so a failed write is retried next round
+snapshot_unwritten = False
+
+def dump_profile(ctx: dict) -> dict:
+    data = {k: v for k, v in ctx.items() if k not in SNAPSHOT_SKIP_KEYS}
+    # prompt_line duplicates question and response, and load_user_context rebuilds it
+    data["history"] = [
+        {k: v for k, v in exchange.items() if k != "prompt_line"} for exchange in ctx["history"]
+    ]
+    return data
+
+def encode_profile(ctx: dict) -> bytes:
+    return orjson.dumps(dump_profile(ctx), default=list)  # deques and profile sets
+
+def refresh_snapshot_blobs() -> list:
+    """Re-encode only the dirty profiles; returns (user_id, blob) pairs, least recently used
+    first so reload keeps LRU order"""
+    for user_id in user_context.dirty:
+        ctx = user_context.get(user_id)
+        if ctx is None:
+            snapshot_blobs.pop(user_id, None)  # Evicted
+        else:
+            snapshot_blobs[user_id] = encode_profile(ctx)
+    user_context.dirty.clear()
+    return [(user_id, snapshot_blobs[user_id]) for user_id in user_context]
+
+def write_snapshot(blobs: list):
+    # Join the pre-encoded profiles into one JSON object keyed by user id
+    data = b"{" + b",".join(b'"%d":%s' % (user_id, blob) for user_id, blob in blobs) + b"}"
+    # Write then rename so a crash mid-write never leaves a truncated snapshot
+    tmp_path = SNAPSHOT_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+def restore_profile(data: dict) -> dict:
+    """Rebuild one saved profile; raises on a malformed entry"""
+    ctx = user_context.factory()
+    ctx.update(data)
+    ctx["history"] = deque(data.get("history", ()), maxlen=MAX_HISTORY)
+    for exchange in ctx["history"]:
+        # Not stored in snapshots; re-render the prompt line from the exchange
+        exchange["prompt_line"] = format_exchange(exchange["question"], exchange["response"])
+    ctx["file_memory"] = deque(data.get("file_memory", ()), maxlen=MAX_FILES)
+    for key in PROFILE_SET_KEYS:
+        ctx[key] = set(data.get(key, ()))
+    return ctx
+
+def load_user_context():
+    """Repopulate user_context from the last snapshot, if there is one"""
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            saved = orjson.loads(f.read())
+        saved_users = saved.items()
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log_info("Could not load user context snapshot: %s", e, user_id="SYSTEM", level=logging.ERROR)
+        return
+    skipped = 0
+    for user_id, data in saved_users:
+        # A truncated or hand-edited entry is dropped rather than stopping startup
+        try:
+            user_context[int(user_id)] = restore_profile(data)
+        except Exception:
+            skipped += 1
+    if skipped:
+        log_info("Skipped %s malformed profiles in %s", skipped, SNAPSHOT_PATH, user_id="SYSTEM", level=logging.WARNING)
+    # Startup hasn't begun serving yet, so encode everything now and keep saves incremental
+    refresh_snapshot_blobs()
+    log_info("Restored %s user profiles from %s", len(user_context), SNAPSHOT_PATH, user_id="SYSTEM")
+
+async def save_snapshot():
+    global snapshot_unwritten
+    if not user_context.dirty and not snapshot_unwritten:
+        return
+    # Only changed profiles are encoded on the loop, so no handler mutates one mid-dump;
+    # joining the blobs and the disk write run in a worker thread
+    blobs = refresh_snapshot_blobs()
+    snapshot_unwritten = True
+    await asyncio.to_thread(write_snapshot, blobs)
+    snapshot_unwritten = False
+
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await save_snapshot()
+        except Exception as e:
+            log_info("Error saving user context snapshot: %s", e, user_id="SYSTEM", level=logging.ERROR)
 
 # COMPREHENSIVE SYSTEM PROMPT with ENHANCED FILE MEMORY SUPPORT AND QUIZ HELP
 SYSTEM_PROMPT = """
@@ -323,70 +561,251 @@ CRITICAL FILE MEMORY CAPABILITY:
 Make learning fast, fun, and continuous, using past questions AND UPLOADED FILES to personalize and engage each user!
 """
 
+# -------------------------
+# Gemini context cache for the static system prompt
+# -------------------------
+PROMPT_CACHE_TTL = timedelta(hours=1)
+# Until (or unless) the cache exists, the system prompt still travels as a system
+# instruction rather than being pasted into every user turn
+base_model = genai.GenerativeModel(model.model_name, system_instruction=SYSTEM_PROMPT) if model else None
+model = base_model
+prompt_cache = None
+
+def cache_system_prompt():
+    """Upload SYSTEM_PROMPT once as cached content so each request only sends the per-turn tail"""
+    global model, prompt_cache
+    if not base_model:
+        return
+    try:
+        cache = genai.caching.CachedContent.create(
+            model=base_model.model_name,
+            system_instruction=SYSTEM_PROMPT,
+            ttl=PROMPT_CACHE_TTL
+        )
+        # Swap the model before publishing the cache so prompts never drop the system prompt early
+        model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+        prompt_cache = cache
+        log_info("System prompt cached as %s", prompt_cache.name, user_id="SYSTEM")
+    except Exception as e:
+        # e.g. prompt below the model's minimum cacheable size - fall back to the uncached instruction
+        prompt_cache = None
+        model = base_model
+        log_info("System prompt caching unavailable, sending it with each request: %s", e, user_id="SYSTEM")
+
+def manage_prompt_cache():
+    """Create the system prompt cache, then extend its TTL before it expires (recreating it if it's gone).
+    Runs in a background thread so the upload overlaps Telegram startup instead of delaying it."""
+    cache_system_prompt()
+    if prompt_cache is None:
+        return
+    while not shutdown_event.wait(PROMPT_CACHE_TTL.total_seconds() * 0.75):
+        try:
+            prompt_cache.update(ttl=PROMPT_CACHE_TTL)
+        except Exception as e:
+            log_info("Refreshing system prompt cache failed, recreating: %s", e, user_id="SYSTEM")
+            cache_system_prompt()
+        if prompt_cache is None:
+            return
+
+# -------------------------
+# Reply cache for standalone questions
+# -------------------------
+RESPONSE_CACHE_TTL = 600  # seconds
+RESPONSE_CACHE_SIZE = 2048
+
+class ResponseCache(OrderedDict):
+    """LRU of recent Gemini replies, each expiring ttl seconds after it was stored"""
+
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        entry = self.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def store(self, key, reply: str):
+        self[key] = (time.monotonic() + self.ttl, reply)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+# -------------------------
+# Precompiled keyword matchers
+# -------------------------
+def compile_keywords(words) -> re.Pattern:
+    """Compile keywords into one alternation that matches them anywhere in the text"""
+    return re.compile("|".join(map(re.escape, words)))
+
+EXACT_GREETINGS = frozenset({"hello", "hi", "hey", "start", "/start", "bonjour", "សួស្តី"})
+GREETING_PREFIXES = ("hello", "hi", "hey")
+GREETING_PREFIX_RE = re.compile(r"^(" + "|".join(GREETING_PREFIXES) + r")(?:[\s,!.]|$)", re.IGNORECASE)
+
+# Reply titles in priority order - the first rule with a matching keyword wins
+TITLE_RULES = (
+    (("file", "document", "upload", "previous", "before"), "📁 File Discussion"),
+    (("translate",), "🌍 Translation"),
+    (("fix", "correct", "grammar"), "📝 Grammar Check"),
+    (("explain", "how", "why"), "💡 Explanation"),
+    (("quiz", "exercise", "practice", "test", "exam"), "🎯 Quiz Help"),
+    (("answer", "solution", "help with"), "✅ Direct Answers"),
+    (("homework", "assignment"), "📚 Homework Help"),
+    (("tense", "verb"), "📚 Grammar Guide"),
+    (("word", "vocab", "phrase"), "📖 Vocabulary"),
+    (("essay", "writing", "write", "composition"), "✍️ Essay Writing"),
+    (("script", "presentation", "speech", "dialogue"), "🎭 Script Writing"),
+    (("outline", "thesis", "paragraph"), "📑 Writing Structure"),
+    (("hello", "hi", "start"), "👋 Welcome"),
+)
+TITLE_BY_KEYWORD = {}
+for _priority, (_keywords, _title) in enumerate(TITLE_RULES):
+    for _keyword in _keywords:
+        TITLE_BY_KEYWORD.setdefault(_keyword, (_priority, _title))
+TITLE_KEYWORD_RE = re.compile(
+    r"\b(" + "|".join(sorted(map(re.escape, TITLE_BY_KEYWORD), key=len, reverse=True)) + ")"
+)
+
+# Writing request categories, each checked with a single regex search
+WRITING_REQUEST_PATTERNS = {
+    "is_essay": compile_keywords(("essay", "composition", "redaction", "អត្ថបទ")),
+    "is_script": compile_keywords(("script", "presentation", "speech", "dialogue")),
+    "is_grammar_check": compile_keywords(("check grammar", "correct this", "fix my writing")),
+    "is_outline": compile_keywords(("outline", "structure", "plan")),
+    "is_thesis": compile_keywords(("thesis", "main idea", "argument")),
+    "is_vocabulary": compile_keywords(("vocabulary", "words for", "terms for")),
+    "is_file_analysis": compile_keywords(("document", "file", "upload", "image", "photo", "screenshot", "pdf", "jpg", "png")),
+    "is_file_followup": compile_keywords(("previous", "before", "last file", "uploaded", "my document", "my file", "that file")),
+    "is_file_question": compile_keywords(("page", "question", "exercise", "section", "part", "explain again")),
+    "is_quiz_help": compile_keywords(("quiz", "test", "exam", "question", "answer", "solution")),
+    "is_homework_help": compile_keywords(("homework", "assignment", "exercise", "problem")),
+    "is_direct_answer": compile_keywords(("answer", "solve", "help with", "what is", "how to", "explain")),
+}
+
+# Learning goal detection for update_learning_profile
+GOAL_TRIGGER_RE = compile_keywords(("want to learn", "need to practice", "want to improve", "goal"))
+LEARNING_GOAL_PATTERNS = (
+    ("grammar", compile_keywords(("grammar",))),
+    ("vocabulary", compile_keywords(("vocabulary",))),
+    ("speaking", compile_keywords(("speak", "conversation", "pronunciation"))),
+    ("writing", compile_keywords(("essay", "writing", "write"))),
+)
+
+# Direct references to files or to something said earlier
+FILE_REFERENCE_RE = compile_keywords((
+    "file", "document", "upload", "pdf", "image", "photo", "screenshot",
+    "previous", "before", "last", "earlier", "that", "the file",
+))
+
+# Markdown cleanup patterns applied to every Gemini reply
+TABLE_CODE_RE = re.compile(r'\|.*?\||```.*?```', re.DOTALL)
+# Single-character deletions go through str.translate - a C table lookup, no regex engine
+MARKDOWN_STRIP_TABLE = str.maketrans('', '', '*_`#')
+BLANK_LINES_RE = re.compile(r'[ \t]*\n\s*\n[ \t]*')
+# Only runs of 2+ spaces - replacing every single space with itself is wasted work
+MULTI_SPACE_RE = re.compile(r' {2,}')
+# Level/language mentions; the named group that matched is the value to store
+LEVEL_RE = re.compile(r"\b(?:(?P<beginner>beginner)|(?P<intermediate>intermediate)|(?P<advanced>advanced))")
+LANGUAGE_RE = re.compile(r"\b(?:(?P<Khmer>khmer|cambodian)|(?P<French>french|français)|(?P<English>english))")
+
+# Words that tie a question to earlier turns, so it can't be answered without this user's history
+FOLLOW_UP_RE = re.compile(
+    r"\b(?:it|that|this|these|those|again|more|continue|last time|previous|above|"
+    r"you said|earlier|before|same|my)\b"
+)
+
+# Any of these means the markdown passes have something to strip
+MARKDOWN_PROBE_CHARS = frozenset('|`*_#')
+
 # -------------------------
 # Formatting helpers
 # -------------------------
+# Telegram caps messages at 4096 characters; leave room for the title and footers
+MAX_BODY_CHARS = 3700
+
 def choose_title_from_user_text(user_text: str, is_file: bool = False) -> str:
     if is_file:
         return "📄 Document Analysis"
-    
-    t = user_text.lower()
-    if any(w in t for w in ["file", "document", "upload", "previous", "before"]):
-        return "📁 File Discussion"
-    if "translate" in t:
-        return "🌍 Translation"
-    if any(w in t for w in ["fix", "correct", "grammar"]):
-        return "📝 Grammar Check"
-    if any(w in t for w in ["explain", "how", "why"]):
-        return "💡 Explanation"
-    if any(w in t for w in ["quiz", "exercise", "practice", "test", "exam"]):
-        return "🎯 Quiz Help"
-    if any(w in t for w in ["answer", "solution", "help with"]):
-        return "✅ Direct Answers"
-    if any(w in t for w in ["homework", "assignment"]):
-        return "📚 Homework Help"
-    if any(w in t for w in ["tense", "verb", "grammar"]):
-        return "📚 Grammar Guide"
-    if any(w in t for w in ["word", "vocab", "phrase"]):
-        return "📖 Vocabulary"
-    if any(w in t for w in ["essay", "writing", "write", "composition"]):
-        return "✍️ Essay Writing"
-    if any(w in t for w in ["script", "presentation", "speech", "dialogue"]):
-        return "🎭 Script Writing"
-    if any(w in t for w in ["outline", "thesis", "paragraph"]):
-        return "📑 Writing Structure"
-    if "hello" in t or "hi" in t or "start" in t:
-        return "👋 Welcome"
+    return title_for_text(user_text.lower())
+
+@lru_cache(maxsize=1024)
+def title_for_text(lower_text: str) -> str:
+    """Title for a lower-cased request - repeated requests (and reused cached replies) skip the scan"""
+    # One regex pass collects every keyword; the highest-priority rule picks the title
+    matches = [TITLE_BY_KEYWORD[m.group(1)] for m in TITLE_KEYWORD_RE.finditer(lower_text)]
+    if matches:
+        return min(matches)[1]
     return "💬 Language Help"
 
+@lru_cache(maxsize=128)
+def _format_epoch_second(second: int) -> str:
+    return datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+
+def format_timestamp(ts: int) -> str:
+    """Render a stored epoch-second value; formatting is cached per second"""
+    return _format_epoch_second(int(ts))
+
 def clean_and_format_text(raw_text: str) -> str:
     if not raw_text:
         return "I couldn't generate a response. Please try again with a different question!"
     
-    # Remove markdown and clean up
-    cleaned = re.sub(r'\|.*?\||```.*?```', '', raw_text, flags=re.DOTALL)
-    cleaned = re.sub(r'[*_`#]', '', cleaned)
-    cleaned = re.sub(r'\n\s*\n', '\n\n', cleaned)
-    cleaned = re.sub(r' +', ' ', cleaned)
+    # Remove markdown and clean up; plain replies skip straight to whitespace cleanup
+    cleaned = raw_text
+    if not MARKDOWN_PROBE_CHARS.isdisjoint(cleaned):
+        cleaned = TABLE_CODE_RE.sub('', cleaned)
+        cleaned = cleaned.translate(MARKDOWN_STRIP_TABLE)
+    cleaned = BLANK_LINES_RE.sub('\n\n', cleaned)
+    cleaned = MULTI_SPACE_RE.sub(' ', cleaned)
     
     return cleaned.strip()
 
+def find_cut(text: str, limit: int) -> int:
+    """Index to truncate text at: the last paragraph, line or word break within limit"""
+    for sep in ('\n\n', '\n', ' '):
+        cut = text.rfind(sep, 0, limit)
+        if cut > 0:
+            return cut
+    return limit
+
+@lru_cache(maxsize=None)
+def title_html(title: str) -> str:
+    """Bold header for a reply title - there are only a handful, so each is escaped once"""
+    return f"<b>{html.escape(title, quote=False)}</b>\n\n"
+
 def make_user_friendly_html(raw_text: str, user_text: str, is_file: bool = False) -> str:
     title = choose_title_from_user_text(user_text, is_file)
     body = clean_and_format_text(raw_text)
     
-    paragraphs = [p.strip() for p in body.split('\n\n') if p.strip()]
-    escaped_paragraphs = [html.escape(p) for p in paragraphs]
-    formatted_body = "\n\n".join(escaped_paragraphs)
+    # Trim the plain text within budget first, then escape it in one pass
+    is_truncated = len(body) > MAX_BODY_CHARS
+    if is_truncated:
+        body = body[:find_cut(body, MAX_BODY_CHARS)]
     
-    final = f"<b>{html.escape(title)}</b>\n\n{formatted_body}"
+    # Quotes only need escaping inside attributes, so skip those two replace passes
+    escaped = html.escape(body, quote=False)
+    # "&" and "<" grow to 4-5 characters each, so a symbol-heavy reply can still overflow;
+    # shrink the plain text in proportion until the escaped form fits the budget
+    while len(escaped) > MAX_BODY_CHARS:
+        is_truncated = True
+        body = body[:find_cut(body, len(body) * MAX_BODY_CHARS // len(escaped))]
+        escaped = html.escape(body, quote=False)
     
-    if len(final) > 4000:
-        truncated = final[:3900]
-        if '\n\n' in truncated:
-            truncated = truncated.rsplit('\n\n', 1)[0]
-        truncated += "\n\n💡 <i>Message too long - feel free to ask follow-up questions!</i>"
-        return truncated
+    final = title_html(title) + escaped
+    
+    if is_truncated:
+        final += "\n\n💡 <i>Message too long - feel free to ask follow-up questions!</i>"
     
     return final
 
@@ -466,37 +885,45 @@ async def process_uploaded_file(file_path: str, file_type: str, user_message: st
         else:
             return f"I'm sorry, I cannot process {file_type} files yet. Please try with PDF, JPG, or PNG files."
         
-        response = vision_model.generate_content([prompt, file_part])
+        # Time out like text replies so a stuck upload can't hold a GEMINI_SEM slot forever
+        async with GEMINI_SEM:
+            async with asyncio.timeout(60.0):  # Files take longer than text
+                response = await vision_model.generate_content_async(
+                    [prompt, file_part], generation_config=VISION_GEN_CONFIG
+                )
         return response.text if hasattr(response, 'text') else "I couldn't analyze this file properly. Please try again."
         
+    except asyncio.TimeoutError:
+        log_info("Timeout processing file", user_id="FILE_PROCESSING")
+        return "Analyzing this file is taking longer than expected. Please try again in a moment or with a smaller file."
     except Exception as e:
-        log_info(f"Error processing file: {e}", "FILE_PROCESSING")
+        log_info("Error processing file: %s", e, user_id="FILE_PROCESSING")
         return f"I encountered an error while processing your file: {str(e)}. Please try again with a different file or format."
 
 # -------------------------
 # ENHANCED MEMORY FUNCTIONS with COMPREHENSIVE FILE SUPPORT
 # -------------------------
-def get_conversation_context(user_id: str, current_question: str) -> str:
+def get_conversation_context(user_id: int, current_question: str) -> str:
     """Get formatted conversation context for the AI with enhanced memory including file references"""
     if user_id not in user_context or len(user_context[user_id]["history"]) <= 1:
         return "First interaction with this student"
     
-    context_lines = []
+    # Get the last CONTEXT_EXCHANGES exchanges for context (to avoid token limits). The newest
+    # entry is the current question, which the prompt already carries as CURRENT REQUEST.
+    history = user_context[user_id]["history"]
+    recent_history = islice(history, max(0, len(history) - 1 - CONTEXT_EXCHANGES), len(history) - 1)
     
-    # Get last 6 exchanges for context (to avoid token limits)
-    recent_history = user_context[user_id]["history"][-12:]  # Last 6 Q&A pairs
-    
-    for exchange in recent_history:
-        if exchange.get('question'):
-            context_lines.append(f"Student: {exchange['question']}")
-        if exchange.get('response'):
-            # Keep full responses for better context
-            response = exchange['response']
-            context_lines.append(f"Tutor: {response}")
-    
-    return "\n".join(context_lines)
+    # Each entry carries its exchange already rendered, so old turns aren't re-formatted
+    return "\n".join(exchange["prompt_line"] for exchange in recent_history)
+
+def format_exchange(question: str, response: str) -> str:
+    """Render one history entry for the prompt; responses kept up to the history budget for better context"""
+    return (
+        f"Student: {question[:MAX_PROMPT_HISTORY_CHARS]}\n"
+        f"Tutor: {response[:MAX_PROMPT_HISTORY_CHARS]}"
+    )
 
-def get_file_memory_context(user_id: str, current_question: str) -> str:
+def get_file_memory_context(user_id: int, current_question: str) -> str:
     """Get comprehensive file memory context for the AI"""
     if user_id not in user_context or not user_context[user_id]["file_memory"]:
         return "No files uploaded yet"
@@ -505,66 +932,114 @@ def get_file_memory_context(user_id: str, current_question: str) -> str:
     file_memory = user_context[user_id]["file_memory"]
     
     # Include the most recent 3 file analyses (to avoid token limits)
-    recent_files = file_memory[-3:]
+    recent_files = islice(file_memory, max(0, len(file_memory) - 3), None)
     
     for i, file_data in enumerate(recent_files):
-        file_context.append(f"FILE {i+1}: {file_data['filename']} (Uploaded: {file_data['timestamp']})")
+        file_context.append(f"FILE {i+1}: {file_data['filename']} (Uploaded: {format_timestamp(file_data['ts'])})")
         file_context.append(f"Analysis: {file_data['analysis'][:800]}...")  # Truncate long analyses
     
     return "\n".join(file_context)
 
-def update_learning_profile(user_id: str, user_text: str, bot_response: str, file_uploaded: bool = False, file_data: dict = None):
+def update_learning_profile(user_id: int, user_text: str, bot_response: str, file_uploaded: bool = False, file_data: dict = None):
     """Update user's learning profile based on conversation"""
+    ctx = user_context.get_or_create(user_id)
     lower_text = user_text.lower()
     
     # Detect learning goals
-    if any(word in lower_text for word in ["want to learn", "need to practice", "want to improve", "goal"]):
-        if "grammar" in lower_text and "grammar" not in user_context[user_id]["learning_goals"]:
-            user_context[user_id]["learning_goals"].append("grammar")
-        if "vocabulary" in lower_text and "vocabulary" not in user_context[user_id]["learning_goals"]:
-            user_context[user_id]["learning_goals"].append("vocabulary")
-        if any(word in lower_text for word in ["speak", "conversation", "pronunciation"]) and "speaking" not in user_context[user_id]["learning_goals"]:
-            user_context[user_id]["learning_goals"].append("speaking")
-        if any(word in lower_text for word in ["essay", "writing", "write"]) and "writing" not in user_context[user_id]["learning_goals"]:
-            user_context[user_id]["learning_goals"].append("writing")
+    if GOAL_TRIGGER_RE.search(lower_text):
+        for goal, pattern in LEARNING_GOAL_PATTERNS:
+            if goal not in ctx["learning_goals"] and pattern.search(lower_text):
+                ctx["learning_goals"].add(goal)
+                ctx["profile_summary"] = None
+                user_context.touch(user_id)
     
     # Track file uploads with enhanced memory
     if file_uploaded and file_data:
         file_memory_entry = {
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "ts": int(time.time()),
             "filename": file_data.get("filename", "Unknown"),
             "file_type": file_data.get("file_type", "Unknown"),
             "user_message": file_data.get("user_message", ""),
             "analysis": file_data.get("analysis", ""),
             "summary": file_data.get("summary", "")[:200]  # Keep summary for quick reference
         }
-        user_context[user_id]["file_memory"].append(file_memory_entry)
-        user_context[user_id]["current_file_analysis"] = file_memory_entry
-        
-        # Keep only last 10 files to prevent memory overload
-        if len(user_context[user_id]["file_memory"]) > 10:
-            user_context[user_id]["file_memory"].pop(0)
+        user_context.add_file(user_id, file_memory_entry)
+        ctx["current_file_analysis"] = file_memory_entry
+        ctx["profile_summary"] = None
+
+def get_learning_profile(ctx: dict) -> str:
+    """Get the learning profile summary, rebuilt only after update_learning_profile changes it"""
+    if ctx["profile_summary"] is None:
+        learning_profile = ""
+        if ctx["learning_goals"]:
+            learning_profile += f"Learning goals: {', '.join(sorted(ctx['learning_goals']))}. "
+        if ctx["weak_areas"]:
+            learning_profile += f"Areas needing practice: {', '.join(sorted(ctx['weak_areas']))}. "
+        if ctx["strengths"]:
+            learning_profile += f"Strengths: {', '.join(sorted(ctx['strengths']))}. "
+        if ctx["writing_projects"]:
+            learning_profile += f"Writing projects: {', '.join(sorted(ctx['writing_projects']))}. "
+        if ctx["file_memory"]:
+            learning_profile += f"Uploaded files: {len(ctx['file_memory'])} files with complete memory. "
+        ctx["profile_summary"] = learning_profile
+    return ctx["profile_summary"]
 
 def detect_writing_request(user_text: str) -> dict:
     """Detect what type of writing assistance is needed"""
     text_lower = user_text.lower()
     request_type = {
-        "is_essay": any(word in text_lower for word in ["essay", "composition", "redaction", "អត្ថបទ"]),
-        "is_script": any(word in text_lower for word in ["script", "presentation", "speech", "dialogue"]),
-        "is_grammar_check": any(word in text_lower for word in ["check grammar", "correct this", "fix my writing"]),
-        "is_outline": any(word in text_lower for word in ["outline", "structure", "plan"]),
-        "is_thesis": any(word in text_lower for word in ["thesis", "main idea", "argument"]),
-        "is_vocabulary": any(word in text_lower for word in ["vocabulary", "words for", "terms for"]),
-        "is_file_analysis": any(word in text_lower for word in ["document", "file", "upload", "image", "photo", "screenshot", "pdf", "jpg", "png"]),
-        "is_file_followup": any(word in text_lower for word in ["previous", "before", "last file", "uploaded", "my document", "my file", "that file"]),
-        "is_file_question": any(word in text_lower for word in ["page", "question", "exercise", "section", "part", "explain again"]),
-        "is_quiz_help": any(word in text_lower for word in ["quiz", "test", "exam", "question", "answer", "solution"]),
-        "is_homework_help": any(word in text_lower for word in ["homework", "assignment", "exercise", "problem"]),
-        "is_direct_answer": any(word in text_lower for word in ["answer", "solve", "help with", "what is", "how to", "explain"])
+        name: pattern.search(text_lower) is not None
+        for name, pattern in WRITING_REQUEST_PATTERNS.items()
     }
     return request_type
 
-def detect_file_reference(user_text: str, user_id: str) -> dict:
+# Typographic quotes dropped from cache keys; operators and other inner punctuation stay,
+# since "2+2" and "2-2" are different questions
+CACHE_KEY_QUOTES = str.maketrans("", "", "«»“”‘’")
+# Sentence marks trimmed from the end of a cache key (Spanish-style openers from the start)
+CACHE_KEY_TRAILING = "?!.។៕… "
+CACHE_KEY_LEADING = "¿¡ "
+
+def standalone_prompt(ctx: dict, writing_instructions: str, question: str) -> str:
+    """Prompt for a question that doesn't depend on who asks it - no name, history, profile or files,
+    so its reply can be shared between students at the same level and language"""
+    return f"""
+STUDENT PROFILE:
+- Level: {ctx['level']}
+- Learning: {ctx['language']}
+{writing_instructions}
+
+CURRENT REQUEST: {question}
+
+PROVIDE DIRECT ANSWERS: If the student is asking for quiz help, homework assistance, or answers to questions, provide COMPLETE SOLUTIONS with detailed explanations.
+
+Provide detailed, practical help:
+"""
+
+def response_cache_key(ctx: dict, lower_text: str, file_reference: dict, writing_instructions: str):
+    """Cache key for a standalone question, or None when its answer needs this user's history or files"""
+    if file_reference["is_referencing_file"] or FOLLOW_UP_RE.search(lower_text):
+        return None
+    # A trailing "?" or curly quotes shouldn't make an otherwise identical question miss
+    question = " ".join(lower_text.translate(CACHE_KEY_QUOTES).split())
+    question = question.rstrip(CACHE_KEY_TRAILING).lstrip(CACHE_KEY_LEADING)
+    # Keyed on the standalone prompt itself, so a hit is exactly what Gemini would have been sent;
+    # a fixed 16-byte digest keeps long questions from bloating the cache's keys
+    return hashlib.blake2b(
+        standalone_prompt(ctx, writing_instructions, question).encode(), digest_size=16
+    ).digest()
+
+def describe_writing_request(writing_request: dict) -> str:
+    """Name only the detected request types rather than printing every flag"""
+    return ", ".join(name for name, detected in writing_request.items() if detected) or "general"
+
+def describe_file_reference(file_reference: dict) -> str:
+    """One-line summary; the analysis itself is already in the file memory section"""
+    if not file_reference["is_referencing_file"]:
+        return "no"
+    return f"yes - latest file {file_reference['referenced_file']['filename']} ({file_reference['total_files']} stored)"
+
+def detect_file_reference(user_text: str, user_id: int) -> dict:
     """Detect if user is referring to previously uploaded files"""
     if user_id not in user_context or not user_context[user_id]["file_memory"]:
         return {"is_referencing_file": False, "referenced_file": None}
@@ -573,10 +1048,7 @@ def detect_file_reference(user_text: str, user_id: str) -> dict:
     file_memory = user_context[user_id]["file_memory"]
     
     # Check for direct references to files
-    file_keywords = ["file", "document", "upload", "pdf", "image", "photo", "screenshot"]
-    reference_keywords = ["previous", "before", "last", "earlier", "that", "the file"]
-    
-    is_referencing = any(word in text_lower for word in file_keywords + reference_keywords)
+    is_referencing = FILE_REFERENCE_RE.search(text_lower) is not None
     
     # Get the most recent file for context
     referenced_file = file_memory[-1] if file_memory else None
@@ -641,143 +1113,396 @@ Just send me your files or requests, and I'll provide comprehensive assistance W
 from telegram import Update
 from telegram.ext import Application, MessageHandler, CallbackContext
 from telegram.ext import filters
-import nest_asyncio
+from telegram.error import Conflict, NetworkError, TimedOut
 
-# Apply nest_asyncio to allow nested event loops
-nest_asyncio.apply()
+# run_polling owns its loop outright, so nested loops are only needed when the bot is
+# driven from an already-running loop (e.g. a notebook); the patch slows every callback
+if os.getenv("NEST_ASYNCIO"):
+    import nest_asyncio
+    nest_asyncio.apply()
 
-async def process_text_message(update: Update, context: CallbackContext, user_text: str, user_id: str, username: str):
-    """Process regular text messages with enhanced file memory"""
-    # Send typing action to show bot is working
+# -------------------------
+# Outbound message queue
+# -------------------------
+# Telegram allows about 30 messages/second per bot; sends drain through a token bucket at that rate
+SEND_RATE = 30
+# How long shutdown waits for queued replies to go out before giving up on them
+SEND_DRAIN_TIMEOUT = 5.0
+send_queue = None
+reply_sender_task = None
+snapshot_task = None
+webhook_check_task = None
+
+def enqueue_send(send, wait: bool = False):
+    """Queue a zero-arg callable that returns a Telegram send coroutine.
+    With wait=True, returns a future resolving to the sent message."""
+    future = asyncio.get_running_loop().create_future() if wait else None
+    send_queue.put_nowait((send, future))
+    return future
+
+def queue_reply(message, text: str, wait: bool = False, **kwargs):
+    return enqueue_send(lambda: message.reply_text(text, **kwargs), wait)
+
+def queue_edit(message, text: str, wait: bool = False, **kwargs):
+    return enqueue_send(lambda: message.edit_text(text, **kwargs), wait)
+
+async def deliver(send, future):
+    """Perform one queued send, reporting failures to the waiter or the log"""
+    try:
+        result = await send()
+    except Exception as e:
+        if future is not None and not future.done():
+            future.set_exception(e)
+        else:
+            log_info("Error sending message: %s", e, user_id="SYSTEM", level=logging.ERROR)
+    else:
+        if future is not None and not future.done():
+            future.set_result(result)
+    finally:
+        send_queue.task_done()
+
+async def reply_sender():
+    """Dispatch queued sends at no more than SEND_RATE per second"""
+    tokens = SEND_RATE
+    last = time.monotonic()
+    while True:
+        send, future = await send_queue.get()
+        now = time.monotonic()
+        tokens = min(SEND_RATE, tokens + (now - last) * SEND_RATE)
+        last = now
+        if tokens < 1:
+            try:
+                await asyncio.sleep((1 - tokens) / SEND_RATE)
+            except asyncio.CancelledError:
+                # Hand the send back so shutdown can fail its future
+                send_queue.put_nowait((send, future))
+                raise
+            tokens = 1
+            last = time.monotonic()
+        tokens -= 1
+        # Sends run concurrently; only their start times are rate limited
+        spawn_background_task(deliver(send, future))
+
+async def start_background_loops(application: Application):
+    global send_queue, reply_sender_task, snapshot_task, webhook_check_task, GEMINI_SEM
+    # Created per Application so the queue and semaphore belong to the loop that polls
+    send_queue = asyncio.Queue()
+    GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    reply_sender_task = asyncio.create_task(reply_sender())
+    snapshot_task = asyncio.create_task(snapshot_loop())
+    if PUBLIC_URL:
+        webhook_check_task = asyncio.create_task(webhook_check_loop(application.bot))
+
+def fail_queued_sends():
+    """Drop sends that will never go out, failing their futures so no waiter hangs"""
+    dropped = 0
+    while not send_queue.empty():
+        _, future = send_queue.get_nowait()
+        send_queue.task_done()
+        dropped += 1
+        if future is not None and not future.done():
+            future.set_exception(RuntimeError("Bot stopped before the message was sent"))
+    if dropped:
+        log_info("Dropped %s queued sends at shutdown", dropped, user_id="SYSTEM", level=logging.WARNING)
+
+async def drain_send_queue(application: Application):
+    """Runs as post_stop, while the bot can still reach Telegram: let queued replies go out"""
+    if send_queue is None:
+        return
+    try:
+        async with asyncio.timeout(SEND_DRAIN_TIMEOUT):
+            await send_queue.join()
+    except asyncio.TimeoutError:
+        log_info("Send queue not drained within %ss", SEND_DRAIN_TIMEOUT, user_id="SYSTEM", level=logging.WARNING)
+
+async def stop_background_loops(application: Application):
+    if reply_sender_task:
+        reply_sender_task.cancel()
+        await asyncio.wait({reply_sender_task})
+    if send_queue is not None:
+        fail_queued_sends()
+    if snapshot_task:
+        snapshot_task.cancel()
+    if webhook_check_task:
+        webhook_check_task.cancel()
     try:
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+        await save_snapshot()
+    except Exception as e:
+        log_info("Error saving user context snapshot: %s", e, user_id="SYSTEM", level=logging.ERROR)
+
+# Strong references so fire-and-forget tasks aren't garbage collected mid-flight
+background_tasks = set()
+
+def spawn_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Seconds a reply may take before the typing indicator is worth an API call
+TYPING_DELAY = 0.8
+# Telegram shows a chat action for about 5 seconds
+TYPING_REFRESH = 4.5
+
+# Telegram allows roughly one message per second per chat, edits included
+STREAM_EDIT_INTERVAL = 1.0
+
+class StreamingReply:
+    """One Telegram message that grows as a streamed reply arrives"""
+
+    def __init__(self, message, user_text: str):
+        self.message = message
+        self.user_text = user_text
+        self.sent = None  # Future for the first message, once something has been shown
+        self.pending = None  # Future for the latest send (first message or edit)
+        self.shown = ""
+        self.parts = []  # Raw text received so far
+
+    def retire_pending(self):
+        """Collect the finished send's outcome, so a failed edit is logged rather than left unobserved"""
+        error = self.pending.exception()
+        if error is not None:
+            log_info("Partial reply send failed: %s", error, user_id="SYSTEM", level=logging.WARNING)
+        self.pending = None
+
+    def update(self, raw_text: str):
+        """Show partial text without waiting on Telegram. Skipped while the previous send is in
+        flight - queued sends are delivered concurrently, so only one may be outstanding at a time"""
+        if self.pending is not None:
+            if not self.pending.done():
+                return
+            self.retire_pending()
+        if self.sent is not None and self.sent.exception() is not None:
+            return
+        reply_html = make_user_friendly_html(raw_text, self.user_text)
+        if self.sent is None:
+            self.sent = self.pending = queue_reply(self.message, reply_html, wait=True, parse_mode="HTML")
+        elif reply_html != self.shown:
+            self.pending = queue_edit(self.sent.result(), reply_html, wait=True, parse_mode="HTML")
+        else:
+            return
+        self.shown = reply_html
+
+    def cut_short(self, note: str, fallback: str) -> str:
+        """Reply after a failed generation: the text received so far plus a note, else the fallback"""
+        partial = "".join(self.parts).rstrip()
+        return f"{partial}\n\n{note}" if partial else fallback
+
+    async def finish(self, reply_html: str):
+        """Replace the partial message with the final reply, or send it if nothing was shown"""
+        if self.sent is not None:
+            # Let the last partial send land first so it can't overwrite the final edit
+            if self.pending is not None:
+                await asyncio.wait({self.pending})
+                self.retire_pending()
+            if self.sent.exception() is None:
+                # Telegram rejects edits that don't change the message
+                if reply_html != self.shown:
+                    queue_edit(self.sent.result(), reply_html, parse_mode="HTML")
+                return
+        queue_reply(self.message, reply_html, parse_mode="HTML")
+
+# Finish reasons that mean Gemini withheld the rest of the reply
+BLOCKED_FINISH_REASONS = frozenset({"SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"})
+
+def chunk_text(chunk) -> str:
+    """Text of one streamed chunk, read from its parts - chunk.text raises on chunks without any,
+    such as a safety block or a bare finish marker"""
+    if not chunk.candidates:
+        return ""
+    return "".join(part.text for part in chunk.candidates[0].content.parts if part.text)
+
+def chunk_block_reason(chunk):
+    """Why Gemini blocked the prompt or stopped the reply, or None"""
+    feedback = chunk.prompt_feedback
+    if feedback and feedback.block_reason:
+        return feedback.block_reason.name
+    for candidate in chunk.candidates[:1]:
+        if candidate.finish_reason.name in BLOCKED_FINISH_REASONS:
+            return candidate.finish_reason.name
+    return None
+
+async def stream_text_reply(prompt: str, reply: StreamingReply) -> str:
+    """Generate response with timeout, showing progress at most every STREAM_EDIT_INTERVAL"""
+    loop = asyncio.get_running_loop()
+    parts = reply.parts
+    block_reason = None
+    async with GEMINI_SEM:
+        async with asyncio.timeout(30.0):  # 30 second timeout
+            response = await model.generate_content_async(prompt, generation_config=GEN_CONFIG, stream=True)
+            next_update = loop.time() + STREAM_EDIT_INTERVAL
+            async for chunk in response:
+                text = chunk_text(chunk)
+                if not text:
+                    block_reason = block_reason or chunk_block_reason(chunk)
+                    continue
+                parts.append(text)
+                if loop.time() >= next_update:
+                    reply.update("".join(parts))
+                    next_update = loop.time() + STREAM_EDIT_INTERVAL
+    # A block only matters when it left nothing to show; the caller asks the student to rephrase
+    if not parts and block_reason:
+        log_info("Gemini blocked the reply: %s", block_reason, user_id="SYSTEM", level=logging.WARNING)
+    return "".join(parts)
+
+# -------------------------
+# Per-user rate limit
+# -------------------------
+RATE_LIMIT_PER_MINUTE = 10
+RATE_LIMIT_BURST = 5
+
+class RateLimiter(OrderedDict):
+    """Token bucket per user: [tokens, last refill, warned], LRU-bounded like user_context"""
+
+    def __init__(self, rate: float, burst: int, max_users: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+
+    def acquire(self, user_id):
+        """Take a token; returns None if allowed, else (seconds to wait, whether to warn)"""
+        now = time.monotonic()
+        bucket = self.get(user_id)
+        if bucket is None:
+            bucket = self[user_id] = [self.burst, now, False]
+            while len(self) > self.max_users:
+                self.popitem(last=False)
+        else:
+            self.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return None
+        # Warn once per empty spell so a flood doesn't turn into a flood of replies
+        warn = not bucket[2]
+        bucket[2] = True
+        return (1 - bucket[0]) / self.rate, warn
+
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE / 60, RATE_LIMIT_BURST, MAX_USERS)
+
+def rate_limited(update: Update, user_id: int) -> bool:
+    """True if this message should be dropped; tells the user when to retry"""
+    limited = rate_limiter.acquire(user_id)
+    if limited is None:
+        return False
+    wait, warn = limited
+    if warn:
+        queue_reply(update.message, f"⏳ You're sending messages very quickly. Please wait {int(wait) + 1} seconds and try again.")
+    return True
+
+# One in-flight turn per user so concurrent messages can't interleave history updates.
+# Entries are [lock, holders+waiters] and are dropped when the last turn finishes,
+# so the dict only ever holds users with messages in progress.
+user_locks = {}
+
+@asynccontextmanager
+async def user_turn(user_id: int):
+    entry = user_locks.get(user_id)
+    if entry is None:
+        entry = user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del user_locks[user_id]
+
+async def send_typing_action(context: CallbackContext, chat_id: int):
+    """Show the typing indicator without holding up the reply"""
+    try:
+        await context.bot.send_chat_action(chat_id=chat_id, action="typing")
     except:
         pass
 
+async def keep_typing(context: CallbackContext, chat_id: int, generation: asyncio.Future, reply: StreamingReply):
+    """Repeat the typing indicator (Telegram clears it after ~5s) until the reply starts showing"""
+    while not generation.done() and reply.sent is None:
+        await send_typing_action(context, chat_id)
+        await asyncio.wait({generation}, timeout=TYPING_REFRESH)
+
+async def process_text_message(update: Update, context: CallbackContext, user_text: str, user_id: int, username: str):
+    """Process regular text messages with enhanced file memory"""
     # FIXED: Only show welcome to truly new users, not for every message
-    is_new_user = user_id not in user_context or len(user_context[user_id]["history"]) == 0
+    existing_ctx = user_context.get(user_id)
+    is_new_user = existing_ctx is None or len(existing_ctx["history"]) == 0
     
     # FIXED: More precise greeting detection - only exact matches
-    exact_greetings = ["hello", "hi", "hey", "start", "/start", "bonjour", "សួស្តី"]
-    user_text_lower = user_text.lower().strip()
-    is_exact_greeting = user_text_lower in exact_greetings
-    is_clear_greeting = any(
-        user_text_lower.startswith(word) for word in ["hello", "hi", "hey", "hi,", "hello,"]
+    lower = user_text.lower()
+    user_text_lower = lower.strip()
+    is_exact_greeting = user_text_lower in EXACT_GREETINGS
+    # startswith rejects most messages in C; the regex then checks the word ends there
+    is_clear_greeting = (
+        user_text_lower.startswith(GREETING_PREFIXES)
+        and GREETING_PREFIX_RE.match(user_text_lower) is not None
     )
     is_greeting = is_exact_greeting or is_clear_greeting
 
     if is_new_user and is_greeting:
-        await update.message.reply_text(WELCOME_MESSAGE, parse_mode="HTML")
-        # Initialize user context
-        user_context[user_id] = {
-            "level": "beginner",
-            "language": "English", 
-            "last_topic": None,
-            "history": [],
-            "first_seen": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "learning_goals": [],
-            "weak_areas": [],
-            "strengths": [],
-            "writing_projects": [],
-            "current_essay": None,
-            "grammar_issues": [],
-            "uploaded_documents": [],
-            "current_file_analysis": None,
-            "file_memory": []
-        }
-        user_context[user_id]["history"].append({
+        queue_reply(update.message, WELCOME_MESSAGE, parse_mode="HTML")
+        # Initialize user context (keeps file memory from uploads sent before the greeting)
+        ctx = user_context.get_or_create(user_id)
+        user_context.add_history(user_id, {
             "question": user_text, 
-            "timestamp": datetime.now().strftime("%H:%M:%S"),
+            "ts": int(time.time()),
             "username": username,
-            "response": "Welcome message sent"
+            "response": "Welcome message sent",
+            "prompt_line": format_exchange(user_text, "Welcome message sent")
         })
         return
     elif is_greeting and not is_new_user:
         # Quick hello for existing users with memory recall
         memory_recall = ""
-        if user_context[user_id]["history"]:
-            last_topic = user_context[user_id]["last_topic"]
+        if existing_ctx["history"]:
+            last_topic = existing_ctx["last_topic"]
             if last_topic:
                 memory_recall = f" Last time we discussed {last_topic}."
         
         # Add file memory recall
-        file_count = len(user_context[user_id]["file_memory"])
+        file_count = len(existing_ctx["file_memory"])
         if file_count > 0:
             memory_recall += f" I remember {file_count} uploaded file(s) from you."
         
-        await update.message.reply_text(f"👋 Hello again {username}!{memory_recall} How can I help you with your language learning today?", parse_mode="HTML")
+        queue_reply(update.message, f"👋 Hello again {username}!{memory_recall} How can I help you with your language learning today?", parse_mode="HTML")
         return
 
     # Initialize user context if not exists (for new users who don't send greetings)
-    if is_new_user:
-        user_context[user_id] = {
-            "level": "beginner",
-            "language": "English", 
-            "last_topic": None,
-            "history": [],
-            "first_seen": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "learning_goals": [],
-            "weak_areas": [],
-            "strengths": [],
-            "writing_projects": [],
-            "current_essay": None,
-            "grammar_issues": [],
-            "uploaded_documents": [],
-            "current_file_analysis": None,
-            "file_memory": []
-        }
+    ctx = user_context.get_or_create(user_id)
 
     # Update user context
-    lower = user_text.lower()
-    if "beginner" in lower:
-        user_context[user_id]["level"] = "beginner"
-    elif "intermediate" in lower:
-        user_context[user_id]["level"] = "intermediate" 
-    elif "advanced" in lower:
-        user_context[user_id]["level"] = "advanced"
-
-    if any(w in lower for w in ["khmer", "cambodian"]):
-        user_context[user_id]["language"] = "Khmer"
-    elif any(w in lower for w in ["french", "français"]):
-        user_context[user_id]["language"] = "French"
-    elif "english" in lower:
-        user_context[user_id]["language"] = "English"
+    level_match = LEVEL_RE.search(lower)
+    if level_match:
+        ctx["level"] = level_match.lastgroup
+        user_context.touch(user_id)
+    language_match = LANGUAGE_RE.search(lower)
+    if language_match:
+        ctx["language"] = language_match.lastgroup
+        user_context.touch(user_id)
 
     # Detect writing request type and file references
     writing_request = detect_writing_request(user_text)
     file_reference = detect_file_reference(user_text, user_id)
     
-    # Update history (keep last 15 messages for better memory)
-    user_context[user_id]["last_topic"] = user_text[:100]
-    if len(user_context[user_id]["history"]) >= 15:
-        user_context[user_id]["history"].pop(0)
+    # Update history (deque keeps the last MAX_HISTORY messages)
+    ctx["last_topic"] = user_text[:100]
     
     # Add current question to history
-    user_context[user_id]["history"].append({
-        "question": user_text, 
-        "timestamp": datetime.now().strftime("%H:%M:%S"),
+    question = user_text[:MAX_STORED_QUESTION_CHARS]
+    user_context.add_history(user_id, {
+        "question": question, 
+        "ts": int(time.time()),
         "username": username,
         "writing_request": writing_request,
-        "file_reference": file_reference
+        # Just the flag - the referenced file already lives in file_memory
+        "file_reference": file_reference["is_referencing_file"],
+        "response": "",  # Filled in once Gemini replies
+        "prompt_line": format_exchange(question, "")
     })
 
-    # Build ENHANCED personalized prompt with memory, writing support, AND file memory
-    conversation_history = get_conversation_context(user_id, user_text)
-    file_memory_context = get_file_memory_context(user_id, user_text)
-    
-    # Build learning profile summary
-    learning_profile = ""
-    if user_context[user_id]["learning_goals"]:
-        learning_profile += f"Learning goals: {', '.join(user_context[user_id]['learning_goals'])}. "
-    if user_context[user_id]["weak_areas"]:
-        learning_profile += f"Areas needing practice: {', '.join(user_context[user_id]['weak_areas'])}. "
-    if user_context[user_id]["strengths"]:
-        learning_profile += f"Strengths: {', '.join(user_context[user_id]['strengths'])}. "
-    if user_context[user_id]["writing_projects"]:
-        learning_profile += f"Writing projects: {', '.join(user_context[user_id]['writing_projects'])}. "
-    if user_context[user_id]["file_memory"]:
-        learning_profile += f"Uploaded files: {len(user_context[user_id]['file_memory'])} files with complete memory. "
-
     # Add writing-specific instructions
     writing_instructions = ""
     if writing_request["is_essay"]:
@@ -811,18 +1536,26 @@ ANSWER FOLLOW-UP QUESTIONS: Provide detailed responses based on the stored file
 PROVIDE DIRECT ANSWERS: Give complete answers to any questions from the uploaded files.
         """
 
-    personalized_prompt = f"""
-{SYSTEM_PROMPT}
-
+    # The system prompt isn't part of the turn - the model carries it as its system instruction.
+    # Standalone questions go out without any personal context, so their replies can be shared
+    cache_key = response_cache_key(ctx, lower, file_reference, writing_instructions)
+    if cache_key:
+        prompt = standalone_prompt(ctx, writing_instructions, user_text[:MAX_PROMPT_USER_CHARS])
+    else:
+        # Build ENHANCED personalized prompt with memory, writing support, AND file memory
+        conversation_history = get_conversation_context(user_id, user_text)
+        file_memory_context = get_file_memory_context(user_id, user_text)
+        learning_profile = get_learning_profile(ctx)
+        prompt = f"""
 STUDENT PROFILE:
 - Name: {username}
-- Level: {user_context[user_id]['level']}
-- Learning: {user_context[user_id]['language']}
-- Recent topic: {user_context[user_id]['last_topic']}
+- Level: {ctx['level']}
+- Learning: {ctx['language']}
+- Recent topic: {ctx['last_topic']}
 - {learning_profile}
 
-WRITING REQUEST TYPE: {writing_request}
-FILE REFERENCE DETECTED: {file_reference}
+WRITING REQUEST TYPE: {describe_writing_request(writing_request)}
+FILE REFERENCE DETECTED: {describe_file_reference(file_reference)}
 {writing_instructions}
 {file_instructions}
 
@@ -832,7 +1565,7 @@ FILE MEMORY CONTEXT (UPLOADED FILES ANALYSIS):
 CONVERSATION HISTORY:
 {conversation_history}
 
-CURRENT REQUEST from {username}: {user_text}
+CURRENT REQUEST from {username}: {user_text[:MAX_PROMPT_USER_CHARS]}
 
 CRITICAL: Reference our previous conversation AND uploaded files. If this is about uploaded files, use the file memory above to provide specific, detailed answers. Build on what we've discussed and provide comprehensive assistance.
 
@@ -849,50 +1582,67 @@ Provide detailed, practical help with file memory support:
         I'm having temporary technical issues. 
         Please try again in a few minutes!
         """
-        await update.message.reply_text(reply_html, parse_mode="HTML")
+        queue_reply(update.message, reply_html, parse_mode="HTML")
         return
 
-    try:
-        # Generate response with timeout
-        response = await asyncio.wait_for(
-            asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: model.generate_content(personalized_prompt)
-            ),
-            timeout=30.0  # 30 second timeout
-        )
-        raw_reply = response.text if hasattr(response, 'text') else "I'm here to help! Could you please rephrase your question?"
-        log_info(f"Response generated for {username}", user_id)
-    except asyncio.TimeoutError:
-        raw_reply = "I'm taking a bit longer than usual to respond. Please try again with a simpler question or wait a moment!"
-        log_info(f"Timeout generating response for {username}", user_id)
-    except Exception as e:
-        raw_reply = "I encountered an issue while processing your request. Please try again with a different question!"
-        log_info(f"Error generating response for {username}: {e}", user_id)
+    reply = StreamingReply(update.message, user_text)
+    raw_reply = response_cache.lookup(cache_key) if cache_key else None
+    if raw_reply is not None:
+        log_info("Cached response reused for %s", username, user_id=user_id, sample=True)
+    else:
+        try:
+            generation = asyncio.ensure_future(stream_text_reply(prompt, reply))
+            # Fast answers go out without a separate typing call; slow ones show the indicator
+            done, _ = await asyncio.wait({generation}, timeout=TYPING_DELAY)
+            if not done:
+                spawn_background_task(keep_typing(context, update.effective_chat.id, generation, reply))
+            raw_reply = await generation
+            log_info("Response generated for %s", username, user_id=user_id, sample=True)
+            if cache_key and raw_reply:
+                response_cache.store(cache_key, raw_reply)
+            if not raw_reply:
+                raw_reply = "I'm here to help! Could you please rephrase your question?"
+        except asyncio.TimeoutError:
+            # Keep any text already on screen rather than replacing it with the error
+            raw_reply = reply.cut_short(
+                "⏳ This reply was cut short because it took too long - ask me to continue for the rest.",
+                "I'm taking a bit longer than usual to respond. Please try again with a simpler question or wait a moment!"
+            )
+            log_info("Timeout generating response for %s", username, user_id=user_id)
+        except Exception as e:
+            raw_reply = reply.cut_short(
+                "⚠️ This reply was interrupted by an error - ask me to continue for the rest.",
+                "I encountered an issue while processing your request. Please try again with a different question!"
+            )
+            log_info("Error generating response for %s: %s", username, e, user_id=user_id)
 
     # Update history with FULL response for better memory
-    user_context[user_id]["history"][-1]["response"] = raw_reply
+    exchange = ctx["history"][-1]
+    exchange["response"] = raw_reply
+    exchange["prompt_line"] = format_exchange(exchange["question"], raw_reply)
+    user_context.touch(user_id)
     
     # Update learning profile based on this interaction
     update_learning_profile(user_id, user_text, raw_reply)
 
-    # Send response
+    # Send response (as an edit when part of it is already on screen)
     reply_html = make_user_friendly_html(raw_reply, user_text)
-    await update.message.reply_text(reply_html, parse_mode="HTML")
+    await reply.finish(reply_html)
 
-async def process_document_message(update: Update, context: CallbackContext, user_id: str, username: str):
+async def process_document_message(update: Update, context: CallbackContext, user_id: int, username: str):
     """Process document uploads (PDF, etc.) with enhanced memory"""
     try:
         document = update.message.document
         file_name = document.file_name
         file_extension = file_name.split('.')[-1].lower() if file_name else "unknown"
         
-        log_info(f"Document upload from {username}: {file_name}", user_id)
+        log_info("Document upload from %s: %s", username, file_name, user_id=user_id)
         
         # Check if file type is supported
         supported_types = ['pdf', 'jpg', 'jpeg', 'png']
         if file_extension not in supported_types:
-            await update.message.reply_text(
+            queue_reply(
+                update.message,
                 f"❌ <b>Unsupported File Type</b>\n\n"
                 f"I can only process: PDF, JPG, PNG files.\n"
                 f"Your file: {file_name}\n"
@@ -902,10 +1652,12 @@ async def process_document_message(update: Update, context: CallbackContext, use
             return
         
         # Send processing message
-        processing_msg = await update.message.reply_text(
+        processing_msg = await queue_reply(
+            update.message,
             f"📄 <b>Processing your {file_extension.upper()} file...</b>\n\n"
             f"<i>Analyzing: {file_name}</i>\n"
             f"This may take a few moments...",
+            wait=True,
             parse_mode="HTML"
         )
         
@@ -942,29 +1694,32 @@ async def process_document_message(update: Update, context: CallbackContext, use
         memory_note = "\n\n💾 <i>I've saved this analysis in memory! You can ask follow-up questions like:</i>\n• <i>'Explain page 3'</i>\n• <i>'Help with question 5'</i>\n• <i>'What was the main point?'</i>\n• <i>'Give me all the answers'</i>"
         full_reply = reply_html + memory_note
         
-        await processing_msg.edit_text(full_reply, parse_mode="HTML")
+        queue_edit(processing_msg, full_reply, parse_mode="HTML")
         
     except Exception as e:
-        log_info(f"Error processing document: {e}", user_id)
-        await update.message.reply_text(
+        log_info("Error processing document: %s", e, user_id=user_id)
+        queue_reply(
+            update.message,
             "❌ <b>Error Processing File</b>\n\n"
             "I encountered an error while processing your file. Please try again with a different file or format.",
             parse_mode="HTML"
         )
 
-async def process_photo_message(update: Update, context: CallbackContext, user_id: str, username: str):
+async def process_photo_message(update: Update, context: CallbackContext, user_id: int, username: str):
     """Process photo uploads (images) with enhanced memory"""
     try:
         # Get the highest quality photo
         photo = update.message.photo[-1]
         
-        log_info(f"Photo upload from {username}", user_id)
+        log_info("Photo upload from %s", username, user_id=user_id)
         
         # Send processing message
-        processing_msg = await update.message.reply_text(
+        processing_msg = await queue_reply(
+            update.message,
             "🖼️ <b>Processing your image...</b>\n\n"
             "<i>Analyzing the content...</i>\n"
             "This may take a few moments...",
+            wait=True,
             parse_mode="HTML"
         )
         
@@ -1001,11 +1756,12 @@ async def process_photo_message(update: Update, context: CallbackContext, user_i
         memory_note = "\n\n💾 <i>I've saved this analysis in memory! You can ask follow-up questions about this image later.</i>"
         full_reply = reply_html + memory_note
         
-        await processing_msg.edit_text(full_reply, parse_mode="HTML")
+        queue_edit(processing_msg, full_reply, parse_mode="HTML")
         
     except Exception as e:
-        log_info(f"Error processing photo: {e}", user_id)
-        await update.message.reply_text(
+        log_info("Error processing photo: %s", e, user_id=user_id)
+        queue_reply(
+            update.message,
             "❌ <b>Error Processing Image</b>\n\n"
             "I encountered an error while processing your image. Please try again with a different image.",
             parse_mode="HTML"
@@ -1014,24 +1770,33 @@ async def process_photo_message(update: Update, context: CallbackContext, user_i
 async def handle_text_message(update: Update, context: CallbackContext):
     """Handle text messages"""
     user_text = update.message.text
-    user_id = str(update.message.from_user.id)
+    user_id = update.message.from_user.id
     username = update.message.from_user.first_name or "Student"
     
-    await process_text_message(update, context, user_text, user_id, username)
+    if rate_limited(update, user_id):
+        return
+    async with user_turn(user_id):
+        await process_text_message(update, context, user_text, user_id, username)
 
 async def handle_document_message(update: Update, context: CallbackContext):
     """Handle document uploads"""
-    user_id = str(update.message.from_user.id)
+    user_id = update.message.from_user.id
     username = update.message.from_user.first_name or "Student"
     
-    await process_document_message(update, context, user_id, username)
+    if rate_limited(update, user_id):
+        return
+    async with user_turn(user_id):
+        await process_document_message(update, context, user_id, username)
 
 async def handle_photo_message(update: Update, context: CallbackContext):
     """Handle photo uploads"""
-    user_id = str(update.message.from_user.id)
+    user_id = update.message.from_user.id
     username = update.message.from_user.first_name or "Student"
     
-    await process_photo_message(update, context, user_id, username)
+    if rate_limited(update, user_id):
+        return
+    async with user_turn(user_id):
+        await process_photo_message(update, context, user_id, username)
 
 async def error_handler(update: Update, context: CallbackContext):
     """Handle errors"""
@@ -1039,55 +1804,140 @@ async def error_handler(update: Update, context: CallbackContext):
     if update and update.effective_user:
         uid = update.effective_user.id
     
-    error_msg = str(context.error) if context.error else "Unknown error"
-    
+    error = context.error
     # Don't log conflict errors as they're normal during deployment
-    if "Conflict" not in error_msg:
-        logger.error(f"Error: {error_msg}", extra={"user_id": uid})
+    if isinstance(error, Conflict):
+        return
+    # PTB retries these itself, so a one-line warning is enough
+    if isinstance(error, (NetworkError, TimedOut)):
+        log_info("Transient network error: %s", error, user_id=uid, level=logging.WARNING)
+        return
+    log_info("Error: %s", error or "Unknown error", user_id=uid, level=logging.ERROR, exc_info=error)
 
 # -------------------------
 # BOT HEALTH MONITORING
 # -------------------------
+# Set once polling stops so background loops exit immediately instead of sleeping it out
+shutdown_event = Event()
+
 def health_check():
     """Periodic health check to ensure bot is running"""
-    while True:
+    while not shutdown_event.is_set():
         try:
-            active_users = len(user_context)
-            total_messages = sum(len(user["history"]) for user in user_context.values())
-            total_files = sum(len(user["file_memory"]) for user in user_context.values())
-            
-            log_info(f"🤖 Health Check: {active_users} active users, {total_messages} messages, {total_files} files in memory", "SYSTEM")
+            log_info("🤖 Health Check: %s/%s active users, %s messages, %s files in memory, "
+                     "reply cache %s hits / %s misses",
+                     len(user_context), user_context.max_users, user_context.total_messages, user_context.total_files,
+                     response_cache.hits, response_cache.misses,
+                     user_id="SYSTEM")
             
             # Keep alive - log every 30 minutes
-            time.sleep(18000)  # 30 minutes
+            shutdown_event.wait(18000)  # 30 minutes
             
         except Exception as e:
-            log_info(f"Health check error: {e}", "SYSTEM")
-            time.sleep(300)  # 5 minutes on error
+            log_info("Health check error: %s", e, user_id="SYSTEM")
+            shutdown_event.wait(300)  # 5 minutes on error
 
 # -------------------------
 # ROBUST MAIN FUNCTION - OPTIMIZED FOR KOYEB
 # -------------------------
+# Webhook mode is used when the service has a public URL. PORT stays with the keep-alive
+# server, so the webhook listens on WEBHOOK_PORT and Telegram POSTs to PUBLIC_URL/telegram -
+# that path must reach WEBHOOK_PORT, not PORT. On Koyeb, expose WEBHOOK_PORT as a second
+# port routed at /telegram (PUBLIC_URL=https://<app>.koyeb.app); elsewhere PUBLIC_URL may
+# name the port itself (https://host:8443 - Telegram accepts 443, 80, 88 and 8443).
+# run_polling removes the webhook again if PUBLIC_URL is later unset.
+PUBLIC_URL = os.getenv("PUBLIC_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = "telegram"
+# Telegram echoes this in a header so forged POSTs to the webhook are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# How often to ask Telegram whether webhook deliveries are failing, in seconds
+WEBHOOK_CHECK_INTERVAL = 300
+
+async def webhook_check_loop(bot):
+    """Log an error whenever Telegram reports a failed delivery to the webhook"""
+    last_error = time.time()
+    while True:
+        await asyncio.sleep(WEBHOOK_CHECK_INTERVAL)
+        try:
+            info = await bot.get_webhook_info()
+        except Exception as e:
+            log_info("Could not fetch webhook info: %s", e, user_id="SYSTEM", level=logging.WARNING)
+            continue
+        # A misrouted URL shows up as delivery errors while updates pile up on Telegram's side
+        if info.last_error_date and info.last_error_date.timestamp() > last_error:
+            last_error = info.last_error_date.timestamp()
+            log_info(
+                "Telegram cannot reach the webhook at %s (%s, %s updates pending) - check that "
+                "/%s is routed to port %s",
+                info.url, info.last_error_message, info.pending_update_count,
+                WEBHOOK_PATH, WEBHOOK_PORT, user_id="SYSTEM", level=logging.ERROR
+            )
+
+# Restart backoff bounds, in seconds
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 120.0
+
 def main():
     """Main function that ensures bot runs forever on Koyeb"""
+    # Use the libuv event loop when available - faster for all the HTTPS traffic
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    
     # 🔥 START KEEP-ALIVE SERVER
     keep_alive()
     
-    log_info("🚀 Starting Comprehensive Language Tutor Bot on Koyeb...", "SYSTEM")
-    log_info(f"🤖 Server running on port {port}", "SYSTEM")
+    log_info("🚀 Starting Comprehensive Language Tutor Bot on Koyeb...", user_id="SYSTEM")
+    log_info("🤖 Server running on port %s", port, user_id="SYSTEM")
+    
+    # Warm restart: bring back profiles from the last snapshot
+    load_user_context()
     
     # Start health monitoring in background thread
     import threading
     health_thread = threading.Thread(target=health_check, daemon=True)
     health_thread.start()
     
-    max_retries = 999  # Keep retrying forever on Koyeb
-    retry_delay = 30
+    # Upload the system prompt to Gemini's context cache concurrently with bot startup;
+    # until it's ready, requests carry the system instruction uncached
+    threading.Thread(target=manage_prompt_cache, daemon=True).start()
+    
+    # Keep retrying forever on Koyeb, with decorrelated jitter between attempts
+    retry_delay = RETRY_BASE_DELAY
+    attempt = 0
     
-    for attempt in range(max_retries):
+    # One loop for the whole process, kept open across restarts (close_loop=False below):
+    # the Gemini SDK caches its grpc.aio client on first use, and that client is bound to
+    # the loop it was created on. The policy (uvloop when installed) supplies the implementation
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    
+    while True:
+        attempt += 1
+        started = time.monotonic()
         try:
             # Build application
-            application = Application.builder().token(TELEGRAM_TOKEN).build()
+            application = (
+                Application.builder()
+                .token(TELEGRAM_TOKEN)
+                # One multiplexed HTTP/2 connection pool shared by all outgoing bot calls
+                .http_version("2")
+                .connection_pool_size(256)
+                .pool_timeout(5.0)
+                # PTB adds the long-poll timeout on top, so getUpdates may take up to 55s to read
+                .get_updates_read_timeout(5.0)
+                .get_updates_connect_timeout(10.0)
+                # Handle updates concurrently so one slow Gemini reply doesn't hold up everyone
+                # else; GEMINI_SEM still bounds upstream calls and user_turn keeps each user in order
+                .concurrent_updates(64)
+                .post_init(start_background_loops)
+                .post_stop(drain_send_queue)
+                .post_shutdown(stop_background_loops)
+                .build()
+            )
             
             # Add handlers for text, documents, and photos
             application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
@@ -1095,29 +1945,49 @@ def main():
             application.add_handler(MessageHandler(filters.PHOTO, handle_photo_message))
             application.add_error_handler(error_handler)
             
-            log_info(f"🔄 Starting Telegram bot polling (attempt {attempt + 1})...", "SYSTEM")
+            log_info("🔄 Starting Telegram bot polling (attempt %s)...", attempt, user_id="SYSTEM")
             
-            # Start polling
-            application.run_polling(
-                poll_interval=3.0,
-                timeout=60,
-                drop_pending_updates=True,
-                allowed_updates=['message', 'edited_message']
-            )
+            if PUBLIC_URL:
+                # Webhook mode - Telegram POSTs updates to us, so nothing holds a poll open;
+                # blocks until SIGINT/SIGTERM
+                application.run_webhook(
+                    listen="0.0.0.0",
+                    port=WEBHOOK_PORT,
+                    url_path=WEBHOOK_PATH,
+                    webhook_url=f"{PUBLIC_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    drop_pending_updates=True,
+                    allowed_updates=[Update.MESSAGE],
+                    close_loop=False
+                )
+            else:
+                # Start long polling - Telegram holds each getUpdates open until an update
+                # arrives, so there is no extra sleep between calls; blocks until SIGINT/SIGTERM
+                application.run_polling(
+                    poll_interval=0.0,
+                    timeout=50,
+                    drop_pending_updates=True,
+                    # Handlers read update.message, so edits would only raise in them
+                    allowed_updates=[Update.MESSAGE],
+                    close_loop=False
+                )
             
-            log_info("✅ Bot is now running with enhanced file memory support!", "SYSTEM")
+            # The bot returned cleanly on a stop signal, so shut down instead of restarting
+            log_info("🛑 Bot stopped, shutting down", user_id="SYSTEM")
+            shutdown_event.set()
+            break
             
         except Exception as e:
-            logger.error(f"❌ Bot crashed on attempt {attempt + 1}: {e}", extra={"user_id": "SYSTEM"})
+            log_info("❌ Bot crashed on attempt %s: %s", attempt, e, user_id="SYSTEM", level=logging.ERROR)
             
-            if attempt < max_retries - 1:
-                log_info(f"🔄 Restarting bot in {retry_delay} seconds...", "SYSTEM")
-                time.sleep(retry_delay)
-            else:
-                log_info("🔁 Maximum retries reached, but continuing anyway...", "SYSTEM")
-                time.sleep(retry_delay)
-                # Reset attempt counter to continue forever
-                attempt = 0
+            # A run that stayed up a while was healthy, so back off from scratch
+            if time.monotonic() - started >= RETRY_MAX_DELAY:
+                retry_delay = RETRY_BASE_DELAY
+            retry_delay = min(RETRY_MAX_DELAY, random.uniform(RETRY_BASE_DELAY, retry_delay * 3))
+            log_info("🔄 Restarting bot in %.1f seconds...", retry_delay, user_id="SYSTEM")
+            time.sleep(retry_delay)
+    
+    loop.close()
 
 if __name__ == "__main__":
     main()